@@ -1,203 +1,172 @@
 import sys
 import socket
+import selectors
 import time
 import argparse
-from packet import Packet
-from collections import deque
-import threading
+import logging
+from packet import Packet, HANDSHAKE
+from input_file import read_attributes
+from array import array
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_SERVER_HOST = '127.0.0.1'
 DEFAULT_SERVER_PORT = 9999
-# The initial buffer size for receiving server max payload size and acknowledgements
-BUFFER_SIZE = 1024
 SLIDING_WINDOW_SIZE = 0
 TIMEOUT = 0
-MAX_PAYLOAD_SIZE = 0
-# The last acknowledged packet by the server
-# Start with -1 to indicate that no packets have been acknowledged yet
-LAST_ACKNOWLEDGED = -1
-# A lock mechanism to lock the access to the LAST_ACKNOWLEDGED variable to 1 thread at a time
-ack_lock = threading.Lock()
+# The maximum number of buffers that a single sendmsg call accepts
+IOV_MAX = 1024
+# The maximum number of acknowledgments received with a single call
+MAX_ACKS_PER_RECEIVE = 4096
 
 
-def handle_acknowledgement(connection_socket: socket.socket, last_ack: int) -> None:
+def handle_acknowledgement(connection_socket: socket.socket, ack_view: memoryview, pending: int) -> tuple[int, int]:
     """
-    Handles the reception and processing of acknowledgment packets from the server.
+    Receives and processes the acknowledgment packets that are waiting on the socket.
 
-    This function runs in a separate thread and continuously listens for acknowledgment
-    packets from the server. It updates the global LAST_ACKNOWLEDGED variable with the
-    highest sequence number acknowledged by the server. If all packets have been acknowledged,
-    it sends a final acknowledgment to the server and terminates.
+    All the waiting acknowledgments are received with a single call into ack_view.
+    The first `pending` bytes of the view hold an acknowledgment that was only partly
+    received by the previous call, TCP is a stream and may split a packet.
 
-    last_ack : int
-        The sequence number of the last packet to be acknowledged.
+    Returns the highest sequence number acknowledged in this call (-1 if no acknowledgment
+    was completed) and the number of bytes of a partly received acknowledgment kept at
+    the start of the view for the next call.
     """
-    global LAST_ACKNOWLEDGED
-    while True:
-        try:
-            # Check if the LAST_ACKNOWLEDGED is equal to the last_ack
-            # If so, all packets have been acknowledged
-            with ack_lock:
-                if LAST_ACKNOWLEDGED == last_ack:
-                    print("All packets have been acknowledged.")
-                    print("Sending final acknowledgment to the server...")
-
-                    # Send a packet that indicates the last packet has been acknowledged
-                    packet = Packet(
-                        last_ack + 1, ack_msg=True, data=b' '*MAX_PAYLOAD_SIZE).pack()
-                    connection_socket.sendall(packet)
-
-                    break
-
-            # Receive the acknowledgments from the server
-            packet_data = connection_socket.recv(Packet.HEADER_SIZE)
-            if not packet_data:
-                break
-            packet = Packet.unpack(packet_data)
-
-            # Extract the sequence number from the acknowledgment packet
-            ack_number = packet.seq_num
-            print(f"ack: {ack_number} received")
-
-            # Update the LAST_ACKNOWLEDGED just if the ack_number is greater than the current value
-            with ack_lock:
-                if ack_number > LAST_ACKNOWLEDGED:
-                    LAST_ACKNOWLEDGED = ack_number
-        except ValueError:
-            print("Error: Could not convert data to an integer.")
-            sys.exit(1)
-        except socket.error as e:
-            print(f"Error: An error occurred with the socket: {e}")
-            break
-        except Exception as e:
-            print(f"Error in handle_acknowledgement: {e}")
-            sys.exit(1)
-
-
-def handle_reliable_transmission(sock: socket.socket, message_fragments: list[bytes]) -> None:
+    received = connection_socket.recv_into(ack_view[pending:])
+    if not received:
+        raise ConnectionError("The server closed the connection")
+    pending += received
+
+    # Process all the acknowledgments that were completely received
+    # Only the sequence number is needed, so the header is read directly
+    # without creating a Packet for every acknowledgment
+    # Each acknowledgment is logged only in verbose mode, printing them slows down the transfer
+    ack_number = -1
+    debug = logger.isEnabledFor(logging.DEBUG)
+    unpack_header = Packet.HEADER.unpack_from
+    complete = pending - pending % Packet.HEADER_SIZE
+    for offset in range(0, complete, Packet.HEADER_SIZE):
+        seq_num = unpack_header(ack_view, offset)[0]
+        if debug:
+            logger.debug("ack: %d received", seq_num)
+        if seq_num > ack_number:
+            ack_number = seq_num
+
+    # Move the partly received acknowledgment to the start of the view
+    pending -= complete
+    if complete:
+        ack_view[:pending] = ack_view[complete:complete + pending]
+    return ack_number, pending
+
+
+def handle_reliable_transmission(sock: socket.socket, message_fragments: list[memoryview]) -> None:
+
+    # The window never holds more packets than the message has, so the ring buffers
+    # below have a slot for each packet of the smaller of the two
+    window_slots = max(1, min(SLIDING_WINDOW_SIZE, len(message_fragments)))
 
     # Initialize the sliding window
-    window = deque(maxlen=SLIDING_WINDOW_SIZE)
-
-    # Initialize the last acknowledged packet by the server
-    curr_ack = -1
-    final_seq = len(message_fragments) - 1
-
-    # Start the acknowledgment handler thread
-    ack_thread = threading.Thread(
-        target=handle_acknowledgement, args=(sock, final_seq))
-    ack_thread.start()
-
-    # loop until all packets have been acknowledged
-    while curr_ack < final_seq:
+    # The window holds the packets from base_seq (the oldest unacknowledged packet)
+    # up to next_seq - 1 (the last packet that was sent), the data of each packet
+    # is taken from message_fragments when it is sent
+    base_seq = 0
+    next_seq = 0
 
-        # Update the current acknowledgment number in each iteration
-        with ack_lock:
-            curr_ack = LAST_ACKNOWLEDGED
+    # The time each packet in the window was sent, kept in a ring buffer
+    # where the packet with sequence number seq is in slot seq % window_slots
+    window_timestamps = array('d', bytes(8 * window_slots))
 
-        # If the window is not full, we do the following:
-        if len(window) < SLIDING_WINDOW_SIZE:
-
-            # Empty the window from the packets that have been acknowledged
-            while window and window[0].seq_num <= curr_ack:
-                window.popleft()
-
-            with ack_lock:
-                curr_ack = LAST_ACKNOWLEDGED
+    final_seq = len(message_fragments) - 1
 
-            # Check what is the next packet that should be sent
-            if window:
-                # if the window is not empty, the next packet from the last in the window should be sent
-                last_seq = window[-1].seq_num + 1
+    # The acknowledgments are received into a single reused buffer
+    # that can hold the acknowledgments of a whole window, up to a limit,
+    # so a huge window size does not allocate a huge buffer
+    ack_view = memoryview(bytearray(
+        Packet.HEADER_SIZE * min(window_slots, MAX_ACKS_PER_RECEIVE)))
+    pending = 0
+
+    # The acknowledgments are handled by the sender itself, the selector wakes it up
+    # as soon as acknowledgments arrive or when the timer of the oldest packet expires
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+
+        # loop until all packets have been acknowledged
+        # Each iteration fills the window, waits for an acknowledgment or a timeout,
+        # and then either slides the window or resends it
+        while base_seq <= final_seq:
+
+            # If the window is not full, send the next packets together in a single call
+            new_seqs = range(next_seq, min(base_seq + SLIDING_WINDOW_SIZE, final_seq + 1))
+            if new_seqs:
+                timestamp = send_packets(new_seqs, message_fragments, sock)
+                for seq in new_seqs:
+                    window_timestamps[seq % window_slots] = timestamp
+                next_seq = new_seqs.stop
+
+            # Wait until acknowledgments arrive or the timer of the oldest packet expires
+            remaining_timeout = TIMEOUT - \
+                (time.monotonic() - window_timestamps[base_seq % window_slots])
+            if selector.select(max(remaining_timeout, 0)):
+                ack_number, pending = handle_acknowledgement(
+                    sock, ack_view, pending)
+
+                # Slide the window past the packets that have been acknowledged
+                base_seq = max(base_seq, ack_number + 1)
             else:
-                # Else, the next packet should be sent is the next packet after the last acknowledged packet
-                last_seq = curr_ack + 1
-
-            # Calculate the number of the new packets that should be sent
-            remain = min(SLIDING_WINDOW_SIZE - len(window),
-                         final_seq - last_seq + 1)
-
-            # Send the new packets
-            for seq in range(last_seq, last_seq + remain):
-                window.append(send_packet(seq, message_fragments[seq], sock))
-
-            with ack_lock:
-                curr_ack = LAST_ACKNOWLEDGED
-
-            # Again, update the window from the packets that have been acknowledged
-            if window:
-                while window and window[0].seq_num <= curr_ack:
-                    window.popleft()
-
-            with ack_lock:
-                curr_ack = LAST_ACKNOWLEDGED
-
-        # If the window is full, we do the following:
-        else:
-            with ack_lock:
-                curr_ack = LAST_ACKNOWLEDGED
-
-            # Update the window from the packets that have been acknowledged
-            while window and window[0].seq_num <= curr_ack:
-                window.popleft()
-
-        # Check for timeout and resend the packets if necessary
-        check_timeout(window, sock)
-        time.sleep(0.01)
-
-    # Wait for the acknowledgment thread to finish
-    time.sleep(1)
-    ack_thread.join()
+                # The timer of the oldest packet expired
+                # Move next_seq back to the oldest packet, so the whole window
+                # is resent with new timestamps by the next iteration
+                # The list is built only when the debug output is enabled
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Window = %s", list(range(base_seq, next_seq)))
+                logger.info("Timeout occurred. Resending packets...")
+                next_seq = base_seq
+
+    print("All packets have been acknowledged.")
+    print("Sending final acknowledgment to the server...")
+
+    # Send a packet that indicates the last packet has been acknowledged
+    Packet(final_seq + 1, ack_msg=True).send(sock)
+
+    # Close the sending side of the connection and wait until the server
+    # closes its side, any acknowledgment still in flight is discarded
+    # The wait is bounded, the transfer is already complete even if the server never closes
+    sock.shutdown(socket.SHUT_WR)
+    sock.settimeout(3 * TIMEOUT)
+    try:
+        while sock.recv_into(ack_view):
+            pass
+    except socket.timeout:
+        logger.debug("The server did not close the connection, closing it anyway.")
 
     # If we've reached this point, all packets have been acknowledged
     print("All fragments sent.")
 
 
-def check_timeout(window: deque, sock: socket.socket) -> None:
-    """
-    Checks the timeout of the packets in the window and resends the packets if necessary.
-
-    This function iterates over the packets in the window and checks if the timeout has
-    expired for any of them. If the timeout has expired, the packet is resent to the server.
-
-    """
-    if window and (time.time() - window[0].timestamp) > TIMEOUT:
-        # To show the window if timeout occurs
-        print(f"Window = {[packet.seq_num for packet in window]}")
-        print("Timeout occurred. Resending packets...")
-        # Send all the packets in the window again
-        for _ in range(len(window)):
-            old_packet = window.popleft()
-            print(f"send packet {old_packet.seq_num} again...")
-            new_packet = send_packet(
-                old_packet.seq_num, old_packet.data, sock)
-            # Append the same packet with the new timestamp
-            window.append(new_packet)
-
-
-def initiate_connection(server_address: str, server_port: int, message: str) -> None:
+def initiate_connection(server_address: str, server_port: int, message: str, interactive: bool = False) -> None:
 
     print(f"Connecting to server at {server_address}:{server_port}")
 
-    global MAX_PAYLOAD_SIZE
-
     # Create a TCP socket object
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as connection_socket:
         try:
+            # Disable Nagle's algorithm, the client sends many small fragments
+            # and should not wait for the kernel to coalesce them
+            if hasattr(socket, "TCP_NODELAY"):
+                connection_socket.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
             # Connect to the server
             connection_socket.connect((server_address, server_port))
 
-            # Initialize the max payload size the server can handle
-            max_payload_size = 0
-
             # Receive the max payload size from the server
-            # The server will send the max payload size as a string
-            # we dont know the size of the max payload size
-            # so we will receive the data in chunk of 1024 bytes
-            max_payload_size = connection_socket.recv(BUFFER_SIZE).decode()
-
-            # Convert the max payload size to an integer
-            max_payload_size = int(max_payload_size)
+            # The server sends it as a fixed size integer, wait until all of it is received
+            handshake = connection_socket.recv(
+                HANDSHAKE.size, socket.MSG_WAITALL)
+            if len(handshake) < HANDSHAKE.size:
+                raise ConnectionError(
+                    "The server closed the connection during the handshake")
+            max_payload_size = HANDSHAKE.unpack(handshake)[0]
 
             print(
                 f"Max payload size that the server can handle: {max_payload_size}")
@@ -209,14 +178,13 @@ def initiate_connection(server_address: str, server_port: int, message: str) ->
                       "Exiting...")
                 return
 
-            MAX_PAYLOAD_SIZE = max_payload_size
+            # Make sure the kernel send buffer is large enough for the whole window
+            size_send_buffer(connection_socket, SLIDING_WINDOW_SIZE *
+                             (max_payload_size + Packet.HEADER_SIZE))
 
         except (ConnectionRefusedError, ConnectionAbortedError):
             print("Error: Connection was refused by the server.")
             return
-        except ValueError:
-            print("Error: Could not convert max payload size to an integer.")
-            return
         except Exception as e:
             print(
                 f"An unexpected error occurred while trying to connect to the server: {e}")
@@ -229,54 +197,109 @@ def initiate_connection(server_address: str, server_port: int, message: str) ->
 
         print(f"Sending {len(message_fragments)} fragments to the server.")
 
-        input("Press Enter to start the transmission...")
+        # Wait for the user only when asked to, so the transfer is not delayed by default
+        if interactive:
+            input("Press Enter to start the transmission...")
 
         # Initiate and start the reliable transmission of the message fragments
-        handle_reliable_transmission(connection_socket, message_fragments)
-        time.sleep(1)
+        try:
+            handle_reliable_transmission(connection_socket, message_fragments)
+        except socket.error as e:
+            print(f"Error: An error occurred with the socket: {e}")
 
     print(
         f"Connection with the server at {server_address}:{server_port} closed.")
 
 
-def send_packet(seq_num, fragment, socket_connection: socket.socket) -> 'Packet':
-    """ Sends a packet to the server and returns the packet object """
-    packet = Packet(seq_num, data=fragment, timestamp=time.time())
-
-    # Send the packet to the server
-    socket_connection.sendall(packet.pack())
-    print(f"Packet {seq_num} sent.")
-    return packet
+def size_send_buffer(connection_socket: socket.socket, window_bytes: int) -> None:
+    """
+    Grows the kernel send buffer of the socket to fit two windows of packets.
 
+    With an undersized buffer sendall blocks before the window is filled. The buffer is
+    never set below its current size, since a fixed size also disables the kernel's own
+    buffer tuning. The kernel may round or cap the size, the granted size is logged.
+    """
+    # The size is passed to the kernel as a C int, which also caps it further
+    wanted_size = min(max(64 * 1024, 2 * window_bytes), 2**31 - 1)
+    if connection_socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) < wanted_size:
+        connection_socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, wanted_size)
+    logger.debug("Send buffer size: %d bytes",
+                 connection_socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+
+
+def send_packets(seq_nums: range, message_fragments: list[memoryview], socket_connection: socket.socket) -> float:
+    """ Sends the packets with the given sequence numbers to the server with a single call and returns the monotonic send time """
+    # Only the headers are packed, the data of each packet is sent from its own fragment
+    # so the payload is never copied, not even when the packet is resent
+    # The headers are packed directly, no Packet object is created for the packets
+    timestamp = time.time()
+    pack_header = Packet.HEADER.pack
+    buffers = []
+    for seq in seq_nums:
+        fragment = message_fragments[seq]
+        buffers.append(pack_header(seq, False, timestamp, len(fragment)))
+        buffers.append(fragment)
+    send_buffers(buffers, socket_connection)
+    if logger.isEnabledFor(logging.DEBUG):
+        for seq in seq_nums:
+            logger.debug("Packet %d sent.", seq)
+    # The timers use the monotonic clock, so they are not affected by changes of the system time
+    return time.monotonic()
+
+
+def send_buffers(buffers: list, socket_connection: socket.socket) -> None:
+    """
+    Sends all the buffers to the server with scatter-gather sendmsg calls.
 
-def split_message_into_fragments(message: str, max_payload_size: int) -> list[bytes]:
+    sendmsg hands all the buffers to the kernel in one system call, without joining
+    them into a single bytes object first. It may send only part of the data, so the
+    call is repeated with the rest of the buffers until everything is sent.
+    """
+    # Platforms without sendmsg fall back to a single joined buffer
+    if not hasattr(socket_connection, "sendmsg"):
+        socket_connection.sendall(b"".join(buffers))
+        return
+
+    while buffers:
+        sent = socket_connection.sendmsg(buffers[:IOV_MAX])
+
+        # Drop the buffers that were sent completely and cut the sent part
+        # of the buffer that was sent partially
+        i = 0
+        while i < len(buffers) and sent >= len(buffers[i]):
+            sent -= len(buffers[i])
+            i += 1
+        buffers = buffers[i:]
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+
+def split_message_into_fragments(message: str, max_payload_size: int) -> list[memoryview]:
     """Splits the message into byte fragments of max payload size that the server can handle"""
-    msg_bytes = message.encode()
+    # The fragments are views over the encoded message, so splitting does not copy it
+    msg_bytes = memoryview(message.encode())
     msg_bytes_len = len(msg_bytes)
 
     # Split the message into fragments which are less than or equal to the max payload size
+    # The last fragment may be shorter, the header holds the size of each fragment
     fragments = [msg_bytes[i:i + max_payload_size]
                  for i in range(0, msg_bytes_len, max_payload_size)]
 
-    if len(fragments[-1]) < max_payload_size:
-        # Padding the last fragment with spaces to make it equal to the max payload size
-        fragments[-1] += b' ' * (max_payload_size - len(fragments[-1]))
-
     return fragments
 
 
 def handle_file_input(file_path: str) -> tuple[str, int, int]:
     """Reads the file and extracts the message, window size, and timeout values"""
     try:
-        with open(file_path, 'r') as file:
-            data = file.read().split('\n')
-            message = data[0].split(':')[1].strip().strip('"\'').strip()
-            window_size = int(data[2].split(':')[1].strip())
-            timeout = float(data[3].split(':')[1].strip())
+        attributes = read_attributes(file_path)
+        message = attributes['message'].strip('"\'').strip()
+        window_size = int(attributes['window_size'])
+        timeout = float(attributes['timeout'])
         return message, window_size, timeout
     except FileNotFoundError:
         print(f"Error: The file {file_path} was not found.")
-    except IndexError:
+    except KeyError:
         print("Error: The file format is incorrect.")
     except ValueError:
         print("Error: Invalid input. Please enter valid integer for the window size and valid float/integer for timeout.")
@@ -311,6 +334,10 @@ if "__main__" == __name__:
                         default=DEFAULT_SERVER_PORT, help='Port number to connect to')
     parser.add_argument('-a', '--address', type=str,
                         default=DEFAULT_SERVER_HOST, help='IP Address to connect to')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show the details of every sent and resent packet')
+    parser.add_argument('-i', '--interactive', action='store_true',
+                        help='Wait for Enter before starting the transmission')
 
     # Adding an option to retrieve the input file as described in the task requirements
     parser.add_argument('-f', '--file', type=str, default=None, help="""File containing the attributes for the server (for server.py and client.py modules).
@@ -333,6 +360,11 @@ timeout:5
 
     args = parser.parse_args()
 
+    # Per packet details are logged at the debug level and hidden unless requested
+    # The log goes to stdout, so it stays in order with the printed messages
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(message)s", stream=sys.stdout)
+
     # If the file option is provided, read the file and extract relevant attributes
     # Otherwise, prompt the user to enter the those attributes
     if args.file:
@@ -356,7 +388,7 @@ timeout:5
 
     print("Starting the connection...")
 
-    initiate_connection(args.address, args.port, message)
+    initiate_connection(args.address, args.port, message, args.interactive)
 
     # End point of the program
     print("Exiting...")
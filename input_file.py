@@ -0,0 +1,15 @@
+def read_attributes(file_path: str) -> dict[str, str]:
+    """
+    Reads the attributes from an input file, such as input.txt, into a dictionary keyed by their names.
+
+    Each line holds one attribute as <name>:<value>, the order of the lines and blank lines do not matter.
+    The names and values are stripped of surrounding whitespace, the values are not converted.
+    Errors opening the file are left to the caller.
+    """
+    attributes = {}
+    with open(file_path, 'r') as file:
+        for line in file:
+            key, separator, value = line.partition(':')
+            if separator:
+                attributes[key.strip()] = value.strip()
+    return attributes
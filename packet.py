@@ -1,7 +1,16 @@
+import socket
 import struct
 import time
 
 
+# Bound once, so creating a packet does not look up the time function in the module
+_time = time.time
+
+# The handshake that the server sends to a new client, the maximum message size
+# as a 4-byte unsigned int in network byte order
+HANDSHAKE = struct.Struct('!I')
+
+
 class Packet:
 
     """
@@ -24,39 +33,96 @@ class Packet:
         The timestamp when the packet was created.
     data : bytes
         The actual data payload of the packet.
+        Any bytes-like object is accepted, it is copied only when the packet is packed.
 
     Methods:
     -------
     pack() -> bytes:
         Packs the packet attributes into a bytes object for transmission.
     unpack(packet: bytes) -> 'Packet':
-        Unpacks a bytes object into a Packet instance.
+        Unpacks a bytes object into a Packet instance, the data is a view over the given object.
+    unpack_from(buffer, offset: int = 0) -> 'Packet':
+        Unpacks the packet found in a buffer at the given offset, the data is a view over the buffer.
+    packet_size(buffer, offset: int = 0) -> int:
+        Returns the size of the packet whose header is found in a buffer at the given offset.
+    pack_header() -> bytes:
+        Packs only the packet header, so the data can be sent separately without copying it.
+    send(sock: socket.socket) -> None:
+        Sends the packet header and data through the socket without joining them first.
     __str__() -> str:
         Returns a string representation of the packet.
     """
 
-    HEADER_FORMAT = 'I?d'
+    # The packets have a fixed set of attributes, so they are stored in slots instead of a dict
+    __slots__ = ('seq_num', 'ack_msg', 'timestamp', 'data')
+
+    # The header holds the sequence number, the acknowledgment flag, the timestamp
+    # and the size of the data, so packets do not need to be padded to a fixed size
+    HEADER_FORMAT = 'I?dI'
+
+    # The compiled header format, so the format string is not parsed on every packet
+    HEADER = struct.Struct(HEADER_FORMAT)
 
     # The size of the packet header in bytes (Without the data payload)
-    HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+    HEADER_SIZE = HEADER.size
 
     def __init__(self, seq_num: int, ack_msg: bool = False, timestamp: float = None, data: bytes = b''):
         self.seq_num = seq_num
         self.ack_msg = ack_msg
-        self.timestamp = timestamp if timestamp is not None else time.time()
+        self.timestamp = timestamp if timestamp is not None else _time()
         self.data = data
 
     def pack(self) -> bytes:
-        return struct.pack(self.HEADER_FORMAT, self.seq_num, self.ack_msg, self.timestamp) + self.data
+        return self.pack_header() + self.data
+
+    def pack_header(self) -> bytes:
+        return self.HEADER.pack(self.seq_num, self.ack_msg, self.timestamp, len(self.data))
+
+    def send(self, sock: socket.socket) -> None:
+        header = self.pack_header()
+
+        # Platforms without sendmsg send the packed packet
+        if not hasattr(sock, "sendmsg"):
+            sock.sendall(header + self.data)
+            return
+
+        # The kernel gathers the header and the data, so they are not joined in memory
+        sent = sock.sendmsg([header, self.data])
+
+        # sendmsg may send only part of the packet, send the rest of it
+        if sent < self.HEADER_SIZE:
+            sock.sendall(header[sent:])
+            sent = self.HEADER_SIZE
+        if sent - self.HEADER_SIZE < len(self.data):
+            sock.sendall(memoryview(self.data)[sent - self.HEADER_SIZE:])
 
     def __str__(self) -> str:
-        return f"Packet(seq_num={self.seq_num}, ack_msg={self.ack_msg}, timestamp={self.timestamp}, data={self.data})"
+        # The data may be a view over a larger buffer, show its content rather than the view
+        return f"Packet(seq_num={self.seq_num}, ack_msg={self.ack_msg}, timestamp={self.timestamp}, data={bytes(self.data)})"
 
     @classmethod
     def unpack(cls, packet: bytes) -> 'Packet':
+        return cls.unpack_from(packet)
+
+    @classmethod
+    def unpack_from(cls, buffer, offset: int = 0) -> 'Packet':
         try:
-            seq_num, ack_msg, timestamp = struct.unpack(
-                cls.HEADER_FORMAT, packet[:cls.HEADER_SIZE])
-            return cls(seq_num, ack_msg, timestamp=timestamp, data=packet[cls.HEADER_SIZE:])
+            seq_num, ack_msg, timestamp, data_size = cls.HEADER.unpack_from(
+                buffer, offset)
         except struct.error as e:
             raise ValueError("Failed to unpack the packet") from e
+
+        # The data is a view over the buffer, so the payload is not copied
+        start = offset + cls.HEADER_SIZE
+        data = memoryview(buffer)[start:start + data_size]
+        if len(data) < data_size:
+            raise ValueError("Failed to unpack the packet, the data is incomplete")
+        return cls(seq_num, ack_msg, timestamp=timestamp, data=data)
+
+    @classmethod
+    def packet_size(cls, buffer, offset: int = 0) -> int:
+        try:
+            data_size = cls.HEADER.unpack_from(buffer, offset)[3]
+        except struct.error as e:
+            raise ValueError("Failed to unpack the packet header") from e
+        return cls.HEADER_SIZE + data_size
@@ -1,20 +1,35 @@
 import argparse
+import logging
+import os
+import selectors
+import signal
 import socket
 import sys
-import threading
 import time
-from packet import Packet
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from packet import Packet, HANDSHAKE
+from input_file import read_attributes
 
+logger = logging.getLogger(__name__)
 
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 9999
-CLIENT_BUFFER_SIZE = 1024
+# The size of the buffer for receiving the packets from a client
+RECEIVE_BUFFER_SIZE = 256 * 1024
+# The maximum number of clients that are handled at the same time
+# Further clients are queued and wait for their handshake until a worker thread is free
+MAX_WORKERS = (os.cpu_count() or 1) * 4
+# The number of connections the kernel queues until they are accepted
+# The operating system may limit it further (somaxconn on Linux)
+LISTEN_BACKLOG = 4096
 # The maximum message size that can be received by the server
 # This value will be set by the user or read from the file
 MAX_MSG_SIZE = 0
 
 
-def handle_acknowledgement(packets: list[Packet], packet: Packet) -> int:
+def handle_acknowledgement(packets: list[Packet], packet: Packet, last_ack: int) -> int:
     """
     Handles the acknowledgment of the received packets and returns the last acknowledged packet number
     Also organizes the received packets in the correct order in the packets list.
@@ -22,6 +37,9 @@ def handle_acknowledgement(packets: list[Packet], packet: Packet) -> int:
     This function processes the received packet by updating the list of packets with the new packet.
     It ensures that packets are stored in the correct order and fills in any gaps with None values.
     The function then returns the highest contiguous sequence number of packets that have been received.
+
+    last_ack is the value returned for the previous packet (-1 before the first one),
+    every packet up to it has been received, so only the packets after it are checked.
     """
     # Extract the sequence number from the packet
     seq_num = packet.seq_num
@@ -38,7 +56,12 @@ def handle_acknowledgement(packets: list[Packet], packet: Packet) -> int:
     # So extend the list with None values and then append the packet
     # The none values indicate which packets are missing
     elif seq_num > packets_len:
-        packets.extend([None for _ in range((seq_num - packets_len))])
+        # A single missing packet is the common case, it is appended without building a list
+        gap = seq_num - packets_len
+        if gap == 1:
+            packets.append(None)
+        else:
+            packets.extend([None] * gap)
         packets.append(packet)
 
     # The sequence number of the recievd packet is less than the length of the packets list
@@ -48,13 +71,60 @@ def handle_acknowledgement(packets: list[Packet], packet: Packet) -> int:
     elif packets[seq_num] is None:
         packets[seq_num] = packet
 
-    # Check if there are any missing packets
-    # If there are missing packets, return the index of the last packet in the sequence
-    # Otherwise, return the length of the packets list - 1 (The last packet in the sequence)
-    for i, pkt in enumerate(packets):
-        if pkt is None:
-            return i - 1
-    return len(packets) - 1
+    # Advance the last acknowledged packet over the packets that are now in sequence
+    # Each packet is passed only once during the whole transfer, instead of scanning
+    # the list from the start for every received packet
+    packets_len = len(packets)
+    while last_ack + 1 < packets_len and packets[last_ack + 1] is not None:
+        last_ack += 1
+    return last_ack
+
+
+def receive_packets(client_socket: socket.socket, view: memoryview, pending: int) -> tuple[Optional[list[Packet]], int]:
+    """
+    Receives the packets that are waiting on the socket and returns them.
+
+    All the waiting data is received with a single call into view, and every packet
+    that was completely received is unpacked from it. The first `pending` bytes of
+    the view hold a packet that was only partly received by the previous call,
+    TCP is a stream and the packets may be split or joined in any way.
+    The packet boundaries are found from the data size in each header.
+
+    Returns the received packets (None if the client closed the connection) and the
+    number of bytes of a partly received packet kept at the start of the view for the next call.
+    """
+    received = client_socket.recv_into(view[pending:])
+    if not received:
+        return None, pending
+    pending += received
+
+    # The names used for every packet are looked up once, before the loop
+    header_size = Packet.HEADER_SIZE
+    max_packet_size = header_size + MAX_MSG_SIZE
+    get_packet_size = Packet.packet_size
+    unpack_from = Packet.unpack_from
+
+    packets = []
+    append = packets.append
+    offset = 0
+    while pending - offset >= header_size:
+        packet_size = get_packet_size(view, offset)
+        if packet_size > max_packet_size:
+            raise ValueError(
+                f"The packet is larger than the maximum message size: {packet_size - header_size}")
+        if pending - offset < packet_size:
+            break
+        packet = unpack_from(view, offset)
+        # The view is reused by the next call, so the data is copied out of it
+        packet.data = bytes(packet.data)
+        append(packet)
+        offset += packet_size
+
+    # Move the partly received packet to the start of the view
+    pending -= offset
+    if offset:
+        view[:pending] = view[offset:offset + pending]
+    return packets, pending
 
 
 def handle_client(client_socket: socket.socket, addr: tuple[str, int]):
@@ -70,53 +140,71 @@ def handle_client(client_socket: socket.socket, addr: tuple[str, int]):
     with client_socket:
         print(f"Connected to {addr}")
 
-        # Send the max message size to the client
-        maximum_message_size = str(MAX_MSG_SIZE).encode()
-
-        # Pad the message to the client buffer size
-        # to ensure that the message is sent correctly
-        maximum_message_size = maximum_message_size + b' ' * \
-            (CLIENT_BUFFER_SIZE - len(maximum_message_size))
-
-        client_socket.sendall(maximum_message_size)
+        # Send the max message size to the client as a fixed size integer
+        client_socket.sendall(HANDSHAKE.pack(MAX_MSG_SIZE))
 
         # List to store all received packets
         # This list will be used to reconstruct the message
         packets = []
 
-        while True:
+        # The last packet up to which all the packets have been received
+        ack_number = -1
+
+        # Buffer for receiving the packets, it holds many small packets
+        # and at least one packet of the maximum size
+        receive_view = memoryview(bytearray(
+            max(RECEIVE_BUFFER_SIZE, MAX_MSG_SIZE + Packet.HEADER_SIZE)))
+        pending = 0
+
+        last_packet_received = False
+        while not last_packet_received:
             try:
-                # Receive the packets from the client
-                # Limit the received data to the maximum message size + the packet header size
-                data = client_socket.recv(MAX_MSG_SIZE + Packet.HEADER_SIZE)
-                if not data:
-                    break
-                # Unpack the received data
-                packet = Packet.unpack(data)
-
-                # If in the recievd packet the ack_msg flag is set, its means that the client
-                # Received acknowledgment for the last packet in the sequence
-                # and the server should stop receiving packets
-                # So, break the loop and close the connection
-                if packet.ack_msg == True and packet.seq_num == len(packets):
-                    print("Last packet received.")
-                    time.sleep(2)
+                # Receive all the packets that are waiting on the socket
+                received_packets, pending = receive_packets(
+                    client_socket, receive_view, pending)
+                if received_packets is None:
                     break
 
-                # This function handles the acknowledgment of the received packets
-                # and returns the last acknowledged packet number
-                # Also, it organizes the received packets in the correct order in the packets list
-                ack_number = handle_acknowledgement(packets, packet)
-                print(f"ack: {ack_number} of the last packet in the sequence")
-
-                # Send the correct acknowledgment number back to the client
-                if ack_number >= 0:
-                    # if ack_number > 150 and ack_number % 50 == 0: ---> for worst case scenario testing
-                    #     input("Press Enter to continue...")
-                    ack_packet = Packet(ack_number, ack_msg=True)
-                    client_socket.sendall(ack_packet.pack())
-                    print(
-                        f"Acknowledgment sent for sequence number: {ack_number}")
+                # Each packet is logged only in verbose mode, printing them slows down the transfer
+                debug = logger.isEnabledFor(logging.DEBUG)
+                # Every packet is acknowledged, the acknowledgments of the whole batch
+                # are packed together and sent with a single call
+                # An acknowledgment is only a header, it is packed directly without a Packet object
+                # and all the acknowledgments of the batch carry the same send time
+                acks = []
+                timestamp = time.time()
+                for packet in received_packets:
+                    # If in the recievd packet the ack_msg flag is set, its means that the client
+                    # Received acknowledgment for the last packet in the sequence
+                    # and the server should stop receiving packets
+                    # So, break the loop and close the connection
+                    # The client has already closed its side, so there is no need to wait
+                    if packet.ack_msg == True and packet.seq_num == len(packets):
+                        print("Last packet received.")
+                        last_packet_received = True
+                        break
+
+                    # This function handles the acknowledgment of the received packets
+                    # and returns the last acknowledged packet number
+                    # Also, it organizes the received packets in the correct order in the packets list
+                    ack_number = handle_acknowledgement(
+                        packets, packet, ack_number)
+                    if debug:
+                        logger.debug(
+                            "ack: %d of the last packet in the sequence", ack_number)
+
+                    # Acknowledge the packet with the correct acknowledgment number
+                    if ack_number >= 0:
+                        # if ack_number > 150 and ack_number % 50 == 0: ---> for worst case scenario testing
+                        #     input("Press Enter to continue...")
+                        acks.append(Packet.HEADER.pack(ack_number, True, timestamp, 0))
+                        if debug:
+                            logger.debug(
+                                "Acknowledgment sent for sequence number: %d", ack_number)
+
+                # Send the acknowledgments of all the packets in the batch at once
+                if acks:
+                    client_socket.sendall(b''.join(acks))
 
             except socket.error as e:
                 print(f"Error occurred with the socket in handle_client: {e}")
@@ -126,13 +214,15 @@ def handle_client(client_socket: socket.socket, addr: tuple[str, int]):
                 break
 
         # After the loop ends, check if there are any missing packets
-        if not packets or None in packets:
+        # Every packet up to ack_number was received, so a packet after it is missing
+        if not packets or ack_number != len(packets) - 1:
             print("Error: Some packets are missing.")
 
         # Combine the packets data and gather the complete message
-        message_bytes = b''.join(
-            list(map(lambda x: x.data, packets))).strip(b' ')
-        message = message_bytes.decode()
+        # join sizes the message once and copies each payload into it a single time
+        message_bytes = b''.join([packet.data for packet in packets])
+        # Invalid UTF-8 is replaced instead of failing, so the rest of the message is still shown
+        message = message_bytes.decode(errors='replace')
 
         # Print the received message
         print(f"Message received: {message}")
@@ -140,32 +230,69 @@ def handle_client(client_socket: socket.socket, addr: tuple[str, int]):
         print(f"Closing connection with {addr}...")
 
 
+def report_client_error(future) -> None:
+    """Prints the traceback of an error that stopped a client handler, the pool would otherwise hide it"""
+    exception = future.exception()
+    if exception is not None:
+        print("Error: The client handler stopped with an unexpected error:")
+        traceback.print_exception(
+            type(exception), exception, exception.__traceback__)
+
+
+def ignore_signal(signum, frame) -> None:
+    """Signal handler that does nothing, the signal is noticed through the wakeup socket"""
+
+
 def initialize_server_socket(address: str, port: int):
 
+    # The clients are handled by a fixed pool of threads that are reused between connections
+    pool = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                              thread_name_prefix="client")
+
+    # On SIGINT or SIGTERM the interpreter writes the signal number to the wakeup socket,
+    # so the accept loop wakes up at once and stops accepting new clients
+    wakeup_receiver, wakeup_sender = socket.socketpair()
+    wakeup_sender.setblocking(False)
+    signal.set_wakeup_fd(wakeup_sender.fileno())
+    signal.signal(signal.SIGINT, ignore_signal)
+    signal.signal(signal.SIGTERM, ignore_signal)
+
     # Create TCP socket for the server
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket, \
+            selectors.DefaultSelector() as selector:
         try:
             # Bind the server socket to the address and port
             server_socket.bind((address, port))
-            server_socket.listen()
+            server_socket.listen(LISTEN_BACKLOG)
             print(f"Server is listening on {address}:{port}")
 
             # # # Set timeout for the server socket
             # server_socket.settimeout(75)
 
-            threads = []
-
             print("Waiting for a connections...")
 
+            # Wait for a new client or for a signal to stop the server
+            selector.register(server_socket, selectors.EVENT_READ)
+            selector.register(wakeup_receiver, selectors.EVENT_READ)
+
             while True:
+                events = selector.select()
+                if any(key.fileobj is wakeup_receiver for key, _ in events):
+                    print("Stopping the server, waiting for the connected clients...")
+                    break
+
                 # Accept the client connection
                 client_socket, addr = server_socket.accept()
 
-                # Create a new thread to handle the client
-                t = threading.Thread(target=handle_client,
-                                     args=(client_socket, addr))
-                t.start()
-                threads.append(t)
+                # Disable Nagle's algorithm so each acknowledgment is sent immediately
+                # The client waits for the acknowledgments before sliding its window
+                if hasattr(socket, "TCP_NODELAY"):
+                    client_socket.setsockopt(
+                        socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+                # Handle the client in one of the pool threads
+                future = pool.submit(handle_client, client_socket, addr)
+                future.add_done_callback(report_client_error)
 
         except socket.timeout:
             print("Connection timed out.")
@@ -177,20 +304,27 @@ def initialize_server_socket(address: str, port: int):
             sys.exit(1)
         finally:
             print("Closing server socket...")
-            for t in threads:
-                t.join()
+            # Restore the default signal handling, so a second Ctrl+C stops the server
+            # without waiting for the clients
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            wakeup_receiver.close()
+            wakeup_sender.close()
+
+            # Wait for the clients that are still being handled
+            pool.shutdown(wait=True)
 
 
 def handle_file_input(file_path: str) -> int:
     """Read the file and extract the maximum message size from it."""
     try:
-        with open(file_path, 'r') as file:
-            data = file.read().split('\n')
-            maximum_msg_size = int(data[1].split(':')[1].strip())
+        attributes = read_attributes(file_path)
+        maximum_msg_size = int(attributes['maximum_msg_size'])
         return maximum_msg_size
     except FileNotFoundError:
         print(f"Error: The file {file_path} was not found.")
-    except IndexError:
+    except KeyError:
         print("Error: The file format is incorrect.")
     except ValueError:
         print("Error: Could not convert data to an integer.")
@@ -223,6 +357,8 @@ if __name__ == '__main__':
                         default=DEFAULT_PORT, help='Port number to bind to')
     parser.add_argument('-a', '--address', type=str,
                         default=DEFAULT_HOST, help='IP Address to bind to')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show the details of every received packet and sent acknowledgment')
 
     # Adding an option to retrieve the requested file as described in the task requirements
     parser.add_argument('-f', '--file', type=str, default=None, help="""File containing the attributes for the server (for server.py and client.py modules).
@@ -245,6 +381,11 @@ timeout:5
 
     args = parser.parse_args()
 
+    # Per packet details are logged at the debug level and hidden unless requested
+    # The log goes to stdout, so it stays in order with the printed messages
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(message)s", stream=sys.stdout)
+
     # If the file option is provided, read the file and extract the maximum message size
     # Otherwise, prompt the user to enter the
     # maximum message size (The only relevant attribute for the server)
@@ -253,6 +394,12 @@ timeout:5
     else:
         maximum_msg_size = handle_user_input()
 
+    # The maximum message size is sent to the clients as a 4-byte unsigned integer
+    if not 0 <= maximum_msg_size <= 0xFFFFFFFF:
+        print("Error: The maximum message size must be between 0 and 4294967295.")
+        print("Exiting...")
+        sys.exit(1)
+
     MAX_MSG_SIZE = maximum_msg_size
     print("Initializing server...")
     initialize_server_socket(args.address, args.port)